@@ -1,13 +1,17 @@
+# NOTE: nearly all of this tool's running time is spent starting git processes
+# rather than in python code, so when optimising, minimise the number of git
+# subprocess invocations before making any other change. A cleanup should run no
+# more than: one fetch, one for-each-ref, one rev-list and one branch -D,
+# regardless of the number of branches. The only extras are creating missing
+# permanent branches and checking out another branch before deleting the current one.
+import collections
+import functools
 import json
 import os
 import os.path
 import subprocess
-from typing import List
 
 import click
-import git
-
-CONFIG_PATH = os.getenv('HOME', '') + '/.config/git-lost.json'
 
 DEFAULT_CONFIG = {
     # names of branches that should never be cleaned up
@@ -35,11 +39,13 @@ DEFAULT_CONFIG = {
 }
 
 
-# read/write config
+# read/write config. The result is cached; use _get_config.cache_clear() to re-read
+@functools.lru_cache(maxsize=None)
 def _get_config():
-    if not os.path.exists(CONFIG_PATH):
+    config_path = os.path.join(os.path.expanduser('~'), '.config', 'git-lost.json')
+    if not os.path.exists(config_path):
         return DEFAULT_CONFIG
-    with open(CONFIG_PATH) as f:
+    with open(config_path) as f:
         # FIXME: it'd be nice to validate the config to make sure it's not
         # going to break anything
         data = json.load(f)
@@ -50,39 +56,127 @@ def _get_config():
 
 
 def _run(cmd):
-    return subprocess.check_output(cmd).decode('utf-8')
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout
+
+
+def _run_lines(cmd, input=None):
+    # like _run(), but yields lines of output as they arrive instead of buffering
+    # the whole thing. If given, `input` is written to the command's stdin first
+    stdin = None if input is None else subprocess.PIPE
+    with subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, encoding='utf-8') as proc:
+        if input is not None:
+            proc.stdin.write(input)
+            proc.stdin.close()
+        for line in proc.stdout:
+            yield line.rstrip('\n')
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+# ANSI escapes for turning bold text on and off
+_BOLD = '\x1b[1m'
+_NOBOLD = '\x1b[22m'
+
+# the prefix for each kind of ref, keyed by the character following "refs/"
+_REF_PREFIXES = {
+    'h': 'refs/heads/',
+    't': 'refs/tags/',
+    'r': 'refs/remotes/',
+}
 
 
-def _get_refs():
-    local = set()
-    remote = {}
-    tags = set()
-
-    # get a list of local branches, remote branches, and tags
-    for line in _run(['git', 'show-ref']).splitlines():
-        sha, ref = line.split(' ')
-        assert ref.startswith('refs/'), ref
-        if ref.startswith('refs/heads/'):
-            local.add(ref[11:])
-        elif ref.startswith('refs/tags/'):
-            tags.add(ref[10:])
-        elif ref.startswith('refs/remotes/'):
-            if not ref.endswith('/HEAD'):
-                name, branch = ref[13:].split('/', 1)
-                remote.setdefault(name, set()).add(branch)
-        elif ref == 'refs/stash':
-            continue
-        else:
-            raise Exception("Unexpected ref %r" % ref)
+class _GitSession:
+    # state shared while examining and deleting branches. ancestry() builds the
+    # commit -> branch names map when first asked for it, and branches recorded with
+    # delete() are all removed by a single `git branch -D` on exit, even if the user
+    # aborted part way through
+    def __init__(self, tips):
+        self._tips = tips
+        self._contains = None
+        # branch name -> sha
+        self._deleted = {}
+
+    def __enter__(self):
+        return self
 
-    return local, remote, tags
+    def __exit__(self, *exc_info):
+        self.bulk_delete()
+
+    def ancestry(self, wanted):
+        if self._contains is None:
+            self._contains = _ancestry_map(self._tips, wanted)
+        return self._contains
+
+    def delete(self, branch, sha):
+        self._deleted[branch] = sha
+
+    def is_deleted(self, branch):
+        return branch in self._deleted
+
+    def bulk_delete(self):
+        if not self._deleted:
+            return
 
+        branches = sorted(self._deleted)
+        for branch in branches:
+            # embed bold on/off escapes directly so the message only needs styling once
+            sha = self._deleted[branch]
+            click.echo(click.style(f'Deleting local branch {_BOLD}{branch}{_NOBOLD}'
+                                   f' (was at {_BOLD}{sha[:8]}{_NOBOLD}).', fg='red'))
+        self._deleted.clear()
+
+        try:
+            _run(['git', 'branch', '-D'] + branches)
+        except subprocess.CalledProcessError:
+            # git deletes what it can, so find out which branches are left over
+            fmt = '--format=%(refname:short)'
+            remaining = _run(['git', 'for-each-ref', fmt]
+                             + ['refs/heads/' + branch for branch in branches]).split()
+            raise click.ClickException(
+                "Could not delete branches: {}".format(', '.join(remaining)))
 
-def _do_fast_forward(repo, name, remote, mustExist=True):
+
+def _get_refs():
+    local = {}
+    remote = collections.defaultdict(dict)
+    tags = []
+    tips = collections.defaultdict(set)
+    current = None
+
+    # get local branches, remote branches and tags from a single for-each-ref, along
+    # with the SHA of each branch and which branch is checked out (if any). `tips`
+    # maps each SHA to the branch names pointing at it, using the same format as
+    # `git branch --all`, i.e. "name" and "remotes/<remote>/<name>"
+    fmt = '--format=%(HEAD) %(objectname) %(refname)'
+    cmd = ['git', 'for-each-ref', fmt, 'refs/heads', 'refs/remotes', 'refs/tags']
+    for line in _run_lines(cmd):
+        # %(HEAD) is "*" for the checked out branch and " " for everything else
+        head = line[0]
+        sha, ref = line[2:].split(' ')
+        kind = ref[5]
+        name = ref[len(_REF_PREFIXES[kind]):]
+        if kind == 'h':
+            local[name] = sha
+            tips[sha].add(name)
+            if head == '*':
+                current = name
+        elif kind == 't':
+            tags.append(name)
+        elif not name.endswith('/HEAD'):
+            rname, branch = name.split('/', 1)
+            remote[rname][branch] = sha
+            tips[sha].add('remotes/' + name)
+
+    return local, dict(remote), set(tags), dict(tips), current
+
+
+def _do_fast_forward(name, remote, mustExist=True):
     raise Exception("TODO: not complete")  # noqa
 
 
-def _createPermanent(repo: git.Repo, name: str, remotes: List[str]) -> None:
+def _createPermanent(name: str,
+                     remotes: list[str],
+                     refs_by_remote: dict[str, dict[str, str]]) -> bool:
     def _err(msg):
         click.secho("WARNING: Can't create permanent branch {}: {}".format(name, msg),
                     fg='red')
@@ -91,120 +185,98 @@ def _createPermanent(repo: git.Repo, name: str, remotes: List[str]) -> None:
 
     if not remotes:
         _err("No remotes configured")
-        return
+        return False
 
     # work out which remote(s) have the branch we want
-    candidateRemotes = [
-        r for r in repo.remotes
-        if r.name in remotes
-        and any(ref.name == '{}/{}'.format(r.name, name) for ref in r.refs)
-    ]
+    candidateRemotes = [r for r in remotes if name in refs_by_remote.get(r, ())]
 
     if not len(candidateRemotes):
         _err("No remotes configured, or no remotes have branch {}".format(name))
-        return
+        return False
 
     if len(candidateRemotes) > 1:
         _err("Multiple remotes have a {} branch".format(name))
-        return
+        return False
 
-    remote = candidateRemotes[0]
+    rname = candidateRemotes[0]
 
     # create the branch
-    repo.git.branch('--track', name, '{}/{}'.format(remote.name, name))
-
-
-def _examine_branch(repo, head, remotes, permanent):
-    # get a list of branches containing this one
-    lines = _run(['git', 'branch', '--all', '--contains=' + head.name])
-    descendants = set(line[2:].rstrip() for line in lines.splitlines())
-
-    # remove the branch from its list of descendants
-    descendants.remove(head.name)
-
-    for perm in permanent:
-        # if the branch is merged to one of the permanent branches locally, we
-        # should remove it
-        if perm in descendants:
-            _request_removal(repo, head, perm, permanent[0])
-            return
-
-        # if the branch is merged to one of the remote permanent branches, we
-        # should remove it
-        for remote in remotes:
-            fullname = 'remotes/{}/{}'.format(remote, perm)
-            if fullname in descendants:
-                _request_removal(repo, head, fullname, permanent[0])
-                return
+    _run(['git', 'branch', '--track', name, f'{rname}/{name}'])
+    return True
+
+
+# map each commit SHA reachable from `tips` to the names of all branches which
+# contain it. Only the entries for commits in `wanted` are guaranteed to be present
+def _ancestry_map(tips, wanted):
+    # walk the commit graph once, pushing each commit's branch names down to its
+    # parents. --topo-order guarantees that children are listed before parents, so
+    # a commit's entry is complete once its own line has been read. That means we
+    # can stop (and kill rev-list) as soon as every commit in `wanted` has been seen
+    contains = {}
+    remaining = set(wanted)
+    cmd = ['git', 'rev-list', '--topo-order', '--parents', '--stdin']
+    lines = _run_lines(cmd, input=''.join(sha + '\n' for sha in tips))
+    try:
+        for line in lines:
+            if not remaining:
+                break
+            commit, *parents = line.split(' ')
+            remaining.discard(commit)
+            names = contains.get(commit, frozenset())
+            if commit in tips:
+                names = contains[commit] = names.union(tips[commit])
+            for parent in parents:
+                existing = contains.get(parent)
+                # frozensets are shared between commits until two lines of history meet
+                contains[parent] = names if existing is None else existing | names
+    finally:
+        lines.close()
+
+    return contains
+
+
+# return the branches which `name` has been merged into, in the order they should be
+# offered to the user. `permanent_refs` is keyed by permanent branch names
+def _collect_removal_candidates(name, sha, permanent_refs, contains) -> list[str]:
+    # get a list of branches containing this one, excluding the branch itself
+    descendants = contains[sha] - {name}
+
+    # nothing else contains this branch, so it hasn't been merged anywhere
+    if not descendants:
+        return []
+
+    # if the branch is merged to one of the permanent branches, either locally or
+    # on a remote, we should remove it
+    hits = descendants & permanent_refs.keys()
+    if hits:
+        return [next(perm for perm in permanent_refs if perm in hits)]
 
     # check remote branches first
-    try_again = set()
-    for other in descendants:
-        if other.startswith('remotes/'):
-            if _request_removal(repo, head, other, permanent[0]):
-                return
-        else:
-            try_again.add(other)
-
-    for other in try_again:
-        if _request_removal(repo, head, other, permanent[0]):
-            return
+    return sorted(descendants, key=lambda other: (not other.startswith('remotes/'), other))
 
 
-def _attempt_removal(repo, local, remotename, other):
-    if remotename is None:
-        otherref = other
-    else:
-        otherref = "/".join((remotename, other))
-
-    current = None if repo.head.is_detached else repo.active_branch.name
-
-    # don't remove the current branch if it's only pushed upstream
-    if local == current and local == other:
-        return False
+def _examine_branch(session, branch, candidates, defaultJump, current):
+    for other in candidates:
+        # skip anything we've deleted since the candidates were collected
+        if session.is_deleted(other):
+            continue
+        if _request_removal(branch, other, defaultJump, current):
+            return True
 
-    # is it an ancestor?
-    merge_base = _run(['git', 'merge-base', local, otherref]).strip()
-    sha = _run(['git', 'rev-parse', '--verify', local]).strip()
-    if sha == merge_base:
-        msg = "{} is merged to {}. Delete it?".format(local, otherref)
-
-        if click.confirm(msg, default=False):
-            # do we need to jump to another branch first?
-            if current == local:
-                # jump to the other thing first
-                _run(['git', 'checkout', otherref])
-
-            click.echo("Deleting local branch {} (was at {})."
-                       .format(local, sha))
-            _run(['git', 'branch', '-D', local])
-        return True
     return False
 
 
-def _request_removal(repo, head, othername, defaultJump):
-    current = None if repo.head.is_detached else repo.active_branch.name
-
+def _request_removal(branch, othername, defaultJump, current):
     msg = "{} is merged to {}. Delete it?".format(
-        click.style(head.name, fg='white', bold=True),
+        click.style(branch, fg='white', bold=True),
         click.style(othername, fg='white', bold=False))
 
     if click.confirm(msg, default=False):
         # do we need to jump to another branch first?
-        if current == head.name:
+        if current == branch:
             # jump to one of the permanent branches first
             _run(['git', 'checkout', defaultJump])
 
-        sha = head.commit.hexsha
-
-        msg = (click.style('Deleting local branch ', fg='red')
-               + click.style(head.name, fg='red', bold=True)  # noqa: W503
-               + click.style(' (was at ', fg='red')           # noqa: W503
-               + click.style(sha[:8], fg='red', bold=True)    # noqa: W503
-               + click.style(').', fg='red')                  # noqa: W503
-               )
-        click.echo(msg)
-        _run(['git', 'branch', '-D', head.name])
         return True
     return False
 
@@ -214,10 +286,6 @@ def _request_removal(repo, head, othername, defaultJump):
 @click.option('-p', '--permanent', multiple=True)
 @click.argument('remote', nargs=-1)
 def cli(fetch, permanent, remote):
-    # get branch list
-    repo = git.Repo()
-    local, remote, _ = _get_refs()
-
     conf = _get_config()
 
     # what are the permanent branches we don't want to destroy?
@@ -242,7 +310,8 @@ def cli(fetch, permanent, remote):
     if fetch:
         click.secho('Fetching from {} ...'.format(', '.join(remotes)),
                     fg='cyan')
-        cmd = ['git', 'fetch', '--multiple']
+        # let git fetch from all the remotes in parallel
+        cmd = ['git', 'fetch', '--multiple', '--jobs={}'.format(len(remotes))]
         if conf['fetch_prune']:
             cmd.append('--prune')
         if conf['fetch_tags']:
@@ -250,32 +319,61 @@ def cli(fetch, permanent, remote):
         cmd.extend(remotes)
         _run(cmd)
 
+    # get branch list
+    local, refs_by_remote, _, tips, current = _get_refs()
+
     # 2) create permanent branches if needed
     if conf['always_create_permanent_branches']:
         for name in permanent:
-            if not hasattr(repo.heads, name):
-                _createPermanent(repo, name, remotes)
+            if name not in local and _createPermanent(name, remotes, refs_by_remote):
+                # the new branch is at the same commit as the remote branch it tracks
+                sha = next(refs_by_remote[r][name] for r in remotes
+                           if name in refs_by_remote.get(r, ()))
+                local[name] = sha
+                tips.setdefault(sha, set()).add(name)
 
     # 3) auto-fast forward any branches that need fastforwarding
     if conf['auto_fast_forward'] in ('ff_permanent', 'ff_all'):
         if len(remotes) == 1:
             for name in permanent:
-                _do_fast_forward(repo, name, remotes[0], False)
+                _do_fast_forward(name, remotes[0], False)
 
     if conf['auto_fast_forward'] == 'ff_all':
         raise Exception("TODO: auto-fast-forward other branches")  # noqa
 
-    # iterate through local branches and try to delete them one by one
-    for head in repo.heads:
-        # don't attempt to clean up permanent branches
-        if head.name in permanent:
+    # the local and remote names of all permanent branches, in order of preference
+    permanent_refs = {}
+    for perm in permanent:
+        permanent_refs[perm] = None
+        for rname in remotes:
+            permanent_refs['remotes/{}/{}'.format(rname, perm)] = None
+
+    # don't attempt to clean up permanent branches
+    branches = []
+    for branch in sorted(local):
+        if branch in permanent:
             click.secho('Not cleaning up permanent branch ',
                         fg='blue', nl=False)
-            click.secho(head.name, fg='blue', bold=True)
-            continue
-
-        # find out if this thing is merged anywhere?
-        _examine_branch(repo, head, remotes, permanent)
+            click.secho(branch, fg='blue', bold=True)
+        else:
+            branches.append(branch)
+
+    with _GitSession(tips) as session:
+        # find out where each local branch is merged. The ancestry map is only built
+        # if there is at least one branch we might clean up
+        pending = []
+        if branches:
+            contains = session.ancestry({local[branch] for branch in branches})
+            for branch in branches:
+                sha = local[branch]
+                candidates = _collect_removal_candidates(branch, sha, permanent_refs, contains)
+                pending.append((branch, sha, candidates))
+
+        # iterate through local branches and ask about deleting them one by one. The
+        # session deletes them all with a single command when we're done
+        for branch, sha, candidates in pending:
+            if _examine_branch(session, branch, candidates, permanent[0], current):
+                session.delete(branch, sha)
 
 
 if __name__ == '__main__':